@@ -0,0 +1,310 @@
+"""Fans note events out to several audio sinks.
+
+Each sink runs on its own thread behind its own queue, so a slow sink (e.g.
+a MIDI port under load) can never delay delivery to the others. Live sinks
+default to a bounded queue that drops ticks under load; recorders default to
+`KEEP_ALL`, so files never lose notes."""
+
+import collections
+import dataclasses
+import heapq
+import socket
+import struct
+import threading
+import time
+
+import mido
+
+import send_sound
+import synth
+
+
+# Drop policies applied when a sink's queue is full. `KEEP_ALL` never drops:
+# the queue is unbounded.
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+KEEP_ALL = "keep_all"
+_DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, KEEP_ALL)
+
+
+def _velocity(note):
+    return max(0, min(int(note.volume), 127))
+
+
+class Sink(object):
+    """Receives the notes started at each tick."""
+
+    name = "sink"
+    # Recorders must see every tick; see `FanOut.add_sink`.
+    lossless = False
+
+    def handle(self, t, notes):
+        """Processes `notes` started at time `t`."""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases resources held by sink."""
+
+
+class MidiPortSink(Sink):
+    """Plays notes on a live MIDI port."""
+
+    name = "midi_port"
+
+    def __init__(self, port=None):
+        self._squeaker = send_sound.Squeaker(port)
+
+    def handle(self, t, notes):
+        for n in notes:
+            self._squeaker.play_note(n)
+        self._squeaker.tick(t)
+
+
+class MidiFileSink(Sink):
+    """Records notes to a MIDI file, written when the sink is closed."""
+
+    name = "midi_file"
+    lossless = True
+
+    def __init__(self, path, ticks_per_beat=480, tempo=500000):
+        self._path = path
+        self._tempo = tempo
+        self._file = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+        self._track = mido.MidiTrack()
+        self._file.tracks.append(self._track)
+        self._pending_off = []
+        self._t0 = None
+        self._last_tick = 0
+        self._count = 0
+
+    def _append(self, msg_type, note, t):
+        tick = int(mido.second2tick(
+            t - self._t0, self._file.ticks_per_beat, self._tempo))
+        tick = max(tick, self._last_tick)
+        self._track.append(mido.Message(
+            msg_type, note=note.note, velocity=_velocity(note),
+            time=tick - self._last_tick))
+        self._last_tick = tick
+
+    def _flush_until(self, t):
+        while self._pending_off and self._pending_off[0][0] <= t:
+            t_off, _, n = heapq.heappop(self._pending_off)
+            self._append('note_off', n, t_off)
+
+    def handle(self, t, notes):
+        if self._t0 is None:
+            self._t0 = t
+        self._flush_until(t)
+        for n in notes:
+            self._append('note_on', n, t)
+            heapq.heappush(self._pending_off, (t + n.duration, self._count, n))
+            self._count += 1
+
+    def close(self):
+        self._flush_until(float("inf"))
+        self._file.save(self._path)
+
+
+class WavSink(Sink):
+    """Renders notes to a WAV file with the built-in software synth."""
+
+    name = "wav"
+    lossless = True
+
+    def __init__(self, path, **kwargs):
+        self._renderer = synth.Renderer(path, **kwargs)
+        self._t0 = None
+
+    def handle(self, t, notes):
+        if self._t0 is None:
+            self._t0 = t
+        self._renderer.render_until(t - self._t0)
+        self._renderer.add_notes([t - self._t0] * len(notes), notes)
+
+    def close(self):
+        self._renderer.close()
+
+
+def _osc_string(s):
+    b = s.encode() + b"\0"
+    return b + b"\0" * (-len(b) % 4)
+
+
+def _osc_message(address, note):
+    """Encodes `note` as OSC message with arguments (note, volume, duration)."""
+    return (_osc_string(address) + _osc_string(",iff") +
+            struct.pack(">iff", int(note.note), note.volume, note.duration))
+
+
+class OscSink(Sink):
+    """Sends each note as an OSC message over UDP."""
+
+    name = "osc"
+
+    def __init__(self, host="127.0.0.1", port=57120, address="/note"):
+        self._target = (host, port)
+        self._address = address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def handle(self, t, notes):
+        for n in notes:
+            self._socket.sendto(_osc_message(self._address, n), self._target)
+
+    def close(self):
+        self._socket.close()
+
+
+class SinkWorker(object):
+    """Delivers ticks to one `Sink` from a bounded queue on its own thread.
+
+    When the queue is full, `drop_policy` decides what happens to a new tick:
+    `DROP_OLDEST` discards the oldest queued tick, `DROP_NEWEST` discards the
+    new one and `COALESCE` merges its notes into the newest queued tick.
+    With `KEEP_ALL` the queue is unbounded and `maxsize` is ignored.
+    """
+
+    def __init__(self, sink, maxsize=64, drop_policy=DROP_OLDEST):
+        if drop_policy not in _DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy {drop_policy}.")
+        if maxsize < 1:
+            raise ValueError("`maxsize` must be at least 1.")
+        self._sink = sink
+        self._maxsize = maxsize
+        self._drop_policy = drop_policy
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"sink-{sink.name}", daemon=True)
+
+        # Metrics.
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_lag = 0.
+        self.max_lag = 0.
+        self._total_lag = 0.
+        self.errors = 0
+        self.last_error = None
+
+    @property
+    def sink(self):
+        return self._sink
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, t, notes):
+        """Queues `notes` for tick `t` without blocking."""
+        with self._cond:
+            if (self._drop_policy != KEEP_ALL and
+                    len(self._queue) >= self._maxsize):
+                if self._drop_policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if self._drop_policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                if self._drop_policy == COALESCE:
+                    _, queued, enqueued = self._queue[-1]
+                    self._queue[-1] = (t, queued + notes, enqueued)
+                    self.coalesced += 1
+                    return
+            self._queue.append((t, notes, time.time()))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                t, notes, enqueued = self._queue.popleft()
+
+            try:
+                self._sink.handle(t, notes)
+            except Exception as exc:
+                # Keep sink alive; failures show up in `metrics`.
+                self._record_error(exc)
+                continue
+
+            lag = time.time() - enqueued
+            with self._cond:
+                self.delivered += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self._total_lag += lag
+
+        try:
+            self._sink.close()
+        except Exception as exc:
+            self._record_error(exc)
+
+    def _record_error(self, exc):
+        with self._cond:
+            self.errors += 1
+            self.last_error = repr(exc)
+
+    def close(self, timeout=None):
+        """Delivers remaining ticks, then stops thread and closes sink."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def metrics(self):
+        """Returns queue depth, drop and error counts and lag (seconds)."""
+        with self._cond:
+            return {
+                "sink": self._sink.name,
+                "depth": len(self._queue),
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "last_lag": self.last_lag,
+                "max_lag": self.max_lag,
+                "mean_lag": self._total_lag / max(self.delivered, 1),
+                "errors": self.errors,
+                "last_error": self.last_error,
+            }
+
+
+class FanOut(object):
+    """Publishes each tick's notes to every registered sink."""
+
+    def __init__(self):
+        self._workers = []
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def add_sink(self, sink, maxsize=64, drop_policy=None):
+        """Starts a worker delivering to `sink`.
+
+        `drop_policy` defaults to `KEEP_ALL` for lossless sinks (recorders)
+        and to `DROP_OLDEST` otherwise."""
+        if drop_policy is None:
+            drop_policy = KEEP_ALL if sink.lossless else DROP_OLDEST
+        w = SinkWorker(sink, maxsize=maxsize, drop_policy=drop_policy)
+        w.start()
+        self._workers.append(w)
+        return w
+
+    def publish(self, t, notes):
+        """Queues `notes` started at `t` for all sinks.
+
+        Each sink gets its own copy of the notes since sinks may modify them
+        (e.g. `Squeaker` stamps `end_time`)."""
+        for w in self._workers:
+            w.put(t, [dataclasses.replace(n) for n in notes])
+
+    def metrics(self):
+        return [w.metrics() for w in self._workers]
+
+    def close(self, timeout=None):
+        """Flushes and closes all sinks, e.g. writing recorded files."""
+        for w in self._workers:
+            w.close(timeout)
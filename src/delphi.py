@@ -1,17 +1,23 @@
 """Test for hops."""
 
 
-from flask import Flask
+from flask import Flask, Response, request
 import ghhops_server as hs
+import rhino3dm
 import threading
 import time
 import re
 
+import audio_sinks
+import preview
 import rhino_delphi
 import send_sound
 import hops_utils
+import state_stream
 
 import multiprocessing as mp
+import signal
+import sys
 
 
 import logging
@@ -28,7 +34,12 @@ lock = threading.Lock()
 event_start = threading.Event()
 event_stop = threading.Event()
 sn = rhino_delphi.Delphi(None, None)
+stream = state_stream.StateBroadcaster()
 GLOBAL_SPEED = [1]
+# Sent on audio pipe to stop audio process.
+AUDIO_STOP = None
+# Maximum rate (frames per second) of `/delphi_stream`.
+_MAX_STREAM_RATE = 50
 
 
 def clamp(n, smallest, largest):
@@ -53,8 +64,18 @@ def delphi_updater(audio_pipe):
                 audio_pipe.send(t)
                 # Update positions every dt.
                 dt = t - last_update
+                snapshot = None
                 with lock:
                     sn.update(dt * GLOBAL_SPEED[0])
+                    # Snapshot for streaming clients; points and JSON are
+                    # computed after releasing the lock.
+                    if stream.due(t):
+                        try:
+                            snapshot = sn.explorer_snapshot()
+                        except Exception:
+                            snapshot = None
+                if snapshot is not None:
+                    stream.publish(t, *rhino_delphi.snapshot_points(snapshot))
                 # Stop updating
                 if event_stop.is_set():
                     event_start.clear()
@@ -76,6 +97,17 @@ def test():
     return e
 
 
+@app.route("/delphi_stream")
+def delphi_stream():
+    """Streams explorer positions as Server-Sent Events.
+
+    Query parameter `rate` sets the maximum frames per second."""
+    rate = clamp(request.args.get("rate", 20, type=float),
+                 0.1, _MAX_STREAM_RATE)
+    return Response(stream.frames(rate), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
 @hops.component(
     '/delphi_add_mite',
     name="Delphi Add Oracle",
@@ -90,9 +122,80 @@ def delphi_add_explorer(trigger, edges, speed, end_behavior):
     speed = hops_utils.list_from_tree(speed)[0]
     end_behavior = hops_utils.list_from_tree(end_behavior)[0]
     if trigger:
-        for e, s, eb in zip(edges, speed, end_behavior):
-            with lock:
-                sn.add_explorer(e, natural_speed=s, end_behavior=eb)
+        n = min(len(edges), len(speed), len(end_behavior))
+        with lock:
+            sn.add_explorers(edges[:n], natural_speed=speed[:n],
+                             end_behavior=end_behavior[:n])
+
+
+@hops.component(
+    '/delphi_add_explorers',
+    name="Delphi Add Explorers",
+    description="Add batch of explorers.",
+    inputs=[hs.HopsBoolean("Add", "Add", "If `True`, adds explorers."),
+            hs.HopsInteger("Edges", "E", access=hs.HopsParamAccess.TREE),
+            hs.HopsNumber("Speed", "Speed", access=hs.HopsParamAccess.TREE),
+            hs.HopsInteger("End Behavior", "EB", access=hs.HopsParamAccess.TREE)],
+    outputs=[hs.HopsInteger("Ids", "Ids", "Ids of added explorers.",
+                            access=hs.HopsParamAccess.LIST)]
+)
+def delphi_add_explorers(trigger, edges, speed, end_behavior):
+    """Adds explorers to edges under a single lock, returns their ids."""
+    if not trigger:
+        return []
+    edges = hops_utils.list_from_tree(edges)
+    speed = hops_utils.list_from_tree(speed)[0]
+    end_behavior = hops_utils.list_from_tree(end_behavior)[0]
+
+    if len(speed) == 1:
+        speed = speed[0]
+    if len(end_behavior) == 1:
+        end_behavior = end_behavior[0]
+
+    with lock:
+        return sn.add_explorers(edges, natural_speed=speed,
+                                end_behavior=end_behavior)
+
+
+@hops.component(
+    '/delphi_remove_explorers',
+    name="Delphi Remove Explorers",
+    description="Remove explorers by id.",
+    inputs=[hs.HopsBoolean("Remove", "Remove", "If `True`, removes explorers."),
+            hs.HopsInteger("Ids", "Ids", access=hs.HopsParamAccess.LIST)],
+    outputs=[hs.HopsInteger("Removed", "R", "Ids of removed explorers.",
+                            access=hs.HopsParamAccess.LIST)]
+)
+def delphi_remove_explorers(trigger, ids):
+    if not trigger:
+        return []
+    with lock:
+        return sn.remove_explorers(ids)
+
+
+@hops.component(
+    '/delphi_query_explorers',
+    name="Delphi Query Explorers",
+    description="Get explorers by id. Returns all explorers if no ids given.",
+    inputs=[hs.HopsInteger("Ids", "Ids", access=hs.HopsParamAccess.LIST,
+                           optional=True)],
+    outputs=[hs.HopsInteger("Ids", "Ids", access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("Node A", "A", access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("Node B", "B", access=hs.HopsParamAccess.LIST),
+             hs.HopsNumber("Location", "L", access=hs.HopsParamAccess.LIST),
+             hs.HopsNumber("Speed", "Speed", access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("End Behavior", "EB",
+                            access=hs.HopsParamAccess.LIST)]
+)
+def delphi_query_explorers(ids=None):
+    with lock:
+        if not ids:
+            ids = sn.explorer_ids()
+        found = [e for e in sn.query_explorers(ids) if e is not None]
+        return ([e.id for e in found], [e.node_a for e in found],
+                [e.node_b for e in found], [e.location for e in found],
+                [e._natural_speed for e in found],
+                [e.end_behavior for e in found])
 
 
 @hops.component(
@@ -164,6 +267,93 @@ def delphi_setup(trigger, nodes, edges):
             sn.set_up(nodes, edges)
 
 
+@hops.component(
+    "/delphi_add_nodes",
+    name="Delphi Add Nodes",
+    description="Add nodes without rebuilding graph.",
+    inputs=[
+        hs.HopsBoolean("Trigger", "Trigger", "Adds nodes."),
+        hs.HopsInteger("Nodes", "N", access=hs.HopsParamAccess.LIST),
+        hs.HopsNumber("Note", "Note", access=hs.HopsParamAccess.LIST),
+        hs.HopsNumber("Note Velocity", "Note Velocity",
+                      access=hs.HopsParamAccess.LIST),
+        hs.HopsNumber("Duration", "Duration", access=hs.HopsParamAccess.LIST)
+        ],
+    outputs=[]
+        )
+def delphi_add_nodes(trigger, nodes, note, note_velocity, duration):
+    if trigger:
+        with lock:
+            for n, nt, v, d in zip(nodes, note, note_velocity, duration):
+                sn.add_node(n, note=clamp(nt, 0, 127), note_velocity=v,
+                            duration=d)
+
+
+@hops.component(
+    "/delphi_remove_nodes",
+    name="Delphi Remove Nodes",
+    description="Remove nodes and their edges without rebuilding graph.",
+    inputs=[
+        hs.HopsBoolean("Trigger", "Trigger", "Removes nodes."),
+        hs.HopsInteger("Nodes", "N", access=hs.HopsParamAccess.LIST),
+        hs.HopsInteger("Rule", "Rule",
+                       "Explorers on removed edges: 0 retire, 1 migrate.")
+        ],
+    outputs=[]
+        )
+def delphi_remove_nodes(trigger, nodes, rule):
+    if trigger:
+        with lock:
+            for n in nodes:
+                sn.remove_node(n, rule)
+
+
+@hops.component(
+    "/delphi_add_edges",
+    name="Delphi Add Edges",
+    description="Add edges without rebuilding graph.",
+    inputs=[
+        hs.HopsBoolean("Trigger", "Trigger", "Adds edges."),
+        hs.HopsInteger("Edges", "E", access=hs.HopsParamAccess.TREE),
+        hs.HopsCurve("Edge Curves", "Edge Curves",
+                     access=hs.HopsParamAccess.TREE),
+        hs.HopsNumber("Speed", "Speed", access=hs.HopsParamAccess.TREE)
+        ],
+    outputs=[]
+        )
+def delphi_add_edges(trigger, edges, edge_path, speed):
+    if trigger:
+        edges = hops_utils.list_from_tree(edges)
+        edge_path = hops_utils.list_from_tree(edge_path)[0]
+        speed = hops_utils.list_from_tree(speed)[0]
+        if len(speed) == 1:
+            speed = speed * len(edges)
+
+        with lock:
+            for e, c, s in zip(edges, edge_path, speed):
+                sn.add_edge(e, curve=c, speed=s)
+
+
+@hops.component(
+    "/delphi_remove_edges",
+    name="Delphi Remove Edges",
+    description="Remove edges without rebuilding graph.",
+    inputs=[
+        hs.HopsBoolean("Trigger", "Trigger", "Removes edges."),
+        hs.HopsInteger("Edges", "E", access=hs.HopsParamAccess.TREE),
+        hs.HopsInteger("Rule", "Rule",
+                       "Explorers on removed edges: 0 retire, 1 migrate.")
+        ],
+    outputs=[]
+        )
+def delphi_remove_edges(trigger, edges, rule):
+    if trigger:
+        edges = hops_utils.list_from_tree(edges)
+        with lock:
+            for e in edges:
+                sn.remove_edge(e, rule)
+
+
 @ hops.component(
     "/delphi_state",
     name="Delphi State",
@@ -181,6 +371,180 @@ def delphi_state():
         return s
 
 
+@hops.component(
+    "/delphi_state_lod",
+    name="Delphi State LOD",
+    description="Get aggregated state of Delphi",
+    inputs=[
+        hs.HopsInteger("Mode", "Mode",
+                       "0 points, 1 per edge, 2 density grid, 3 sample."),
+        hs.HopsInteger("Count", "K", "Maximum number of sampled points."),
+        hs.HopsInteger("Resolution", "R", "Grid cells along each axis.")
+        ],
+    outputs=[hs.HopsPoint("Points", "P", "Aggregated positions.",
+                          access=hs.HopsParamAccess.LIST),
+             hs.HopsNumber("Values", "V", "Counts or explorer ids.",
+                           access=hs.HopsParamAccess.LIST)]
+    )
+def delphi_state_lod(mode, count, resolution):
+    with lock:
+        points, values = sn.state_lod(mode, k=count, resolution=resolution)
+    if mode != rhino_delphi.LOD_POINTS:
+        points = [rhino3dm.Point3d(*p) for p in points.tolist()]
+    return points, [float(v) for v in values]
+
+
+@hops.component(
+    "/delphi_enable_trails",
+    name="Delphi Enable Trails",
+    description="Record explorer trails.",
+    inputs=[hs.HopsInteger("Length", "L",
+                           "Number of steps kept per trail; 0 disables.")],
+    outputs=[]
+    )
+def delphi_enable_trails(length):
+    with lock:
+        sn.enable_trails(length)
+    return None
+
+
+@hops.component(
+    "/delphi_trails",
+    name="Delphi Trails",
+    description="Get recent positions of explorers.",
+    inputs=[hs.HopsInteger("Ids", "Ids", "Explorers; all if empty.",
+                           access=hs.HopsParamAccess.LIST, optional=True)],
+    outputs=[hs.HopsInteger("Ids", "Ids", access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("Counts", "C", "Number of points per trail.",
+                            access=hs.HopsParamAccess.LIST),
+             hs.HopsPoint("Points", "P", "Trail points, oldest first.",
+                          access=hs.HopsParamAccess.LIST)]
+    )
+def delphi_trails(ids=None):
+    with lock:
+        ids, counts, points = sn.trails(ids or None)
+    return (ids, counts.tolist(),
+            [rhino3dm.Point3d(*p) for p in points.tolist()])
+
+
+@hops.component(
+    "/delphi_nearest_node",
+    name="Delphi Nearest Node",
+    description="Find node nearest to point.",
+    inputs=[hs.HopsPoint("Point", "P", "Query point.")],
+    outputs=[hs.HopsInteger("Node", "N", "Nearest node."),
+             hs.HopsNumber("Distance", "D", "Distance to node.")]
+    )
+def delphi_nearest_node(point):
+    with lock:
+        node, distance = sn.nearest_node(point)
+    if node is None:
+        return -1, -1.0
+    return node, float(distance)
+
+
+@hops.component(
+    "/delphi_nearest_edge",
+    name="Delphi Nearest Edge",
+    description="Find edge nearest to point.",
+    inputs=[hs.HopsPoint("Point", "P", "Query point.")],
+    outputs=[hs.HopsInteger("Edge", "E", "Nodes of nearest edge.",
+                            access=hs.HopsParamAccess.LIST),
+             hs.HopsNumber("Distance", "D", "Distance to edge.")]
+    )
+def delphi_nearest_edge(point):
+    with lock:
+        edge, distance = sn.nearest_edge(point)
+    if edge is None:
+        return [], -1.0
+    return list(edge), float(distance)
+
+
+@hops.component(
+    "/delphi_region",
+    name="Delphi Region",
+    description="Find explorers inside box.",
+    inputs=[hs.HopsPoint("Corner A", "A", "First corner of box."),
+            hs.HopsPoint("Corner B", "B", "Opposite corner of box.")],
+    outputs=[hs.HopsInteger("Explorers", "Ids", "Ids of explorers in box.",
+                            access=hs.HopsParamAccess.LIST)]
+    )
+def delphi_region(corner_a, corner_b):
+    with lock:
+        snapshot = sn.explorer_snapshot()
+    return rhino_delphi.snapshot_in_region(snapshot, corner_a, corner_b)
+
+
+@hops.component(
+    "/delphi_preview",
+    name="Delphi Preview",
+    description="Preview upcoming notes.",
+    inputs=[hs.HopsNumber("Horizon", "H", "Seconds to look ahead."),
+            hs.HopsInteger("Max Events", "M", "Maximum number of events.")],
+    outputs=[hs.HopsNumber("Time", "T", "Seconds until note.",
+                           access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("Node", "N", "Node played.",
+                            access=hs.HopsParamAccess.LIST),
+             hs.HopsInteger("Note", "Note", "Note played.",
+                            access=hs.HopsParamAccess.LIST)]
+    )
+def delphi_preview(horizon, max_events):
+    with lock:
+        events = preview.upcoming_notes(
+            sn, horizon, time_scale=GLOBAL_SPEED[0], max_events=max_events)
+    if not events:
+        return [], [], []
+    t, node, note = zip(*events)
+    return list(t), list(node), list(note)
+
+
+@hops.component(
+    "/delphi_node_rules",
+    name="Delphi Node Rules",
+    description="Set cooldown, every Nth arrival and threshold of nodes.",
+    inputs=[
+        hs.HopsInteger("Nodes", "N", access=hs.HopsParamAccess.LIST),
+        hs.HopsNumber("Cooldown", "C", "Seconds between notes.",
+                      access=hs.HopsParamAccess.LIST),
+        hs.HopsInteger("Every N", "EN", "Play every Nth arrival.",
+                       access=hs.HopsParamAccess.LIST),
+        hs.HopsInteger("Threshold", "T", "Arrivals needed within window.",
+                       access=hs.HopsParamAccess.LIST),
+        hs.HopsNumber("Window", "W",
+                      "Seconds in which threshold arrivals are counted.",
+                      access=hs.HopsParamAccess.LIST, optional=True)
+        ],
+    outputs=[]
+    )
+def delphi_node_rules(nodes, cooldown, every_n, threshold, window=None):
+    if len(cooldown) == 1:
+        cooldown = cooldown[0]
+    if len(every_n) == 1:
+        every_n = every_n[0]
+    if len(threshold) == 1:
+        threshold = threshold[0]
+    if window is not None and len(window) == 1:
+        window = window[0]
+    with lock:
+        sn.set_node_rules(nodes, cooldown=cooldown, every_n=every_n,
+                          threshold=threshold, window=window)
+    return None
+
+
+@hops.component(
+    "/delphi_meetings",
+    name="Delphi Meetings",
+    description="Play notes when explorers meet on an edge.",
+    inputs=[hs.HopsBoolean("Play", "Play",
+                           "If `True`, meetings play the nearest node.")],
+    outputs=[]
+    )
+def delphi_meetings(play):
+    with lock:
+        sn.play_meetings = play
+    return None
+
+
 @hops.component(
     "/run_delphi",
     name="run_delphi",
@@ -213,21 +577,55 @@ def run_app():
     app.run(threaded=True)
 
 
-def audio(audio_pipe):
+def default_sinks(fan_out):
+    """Registers sinks receiving audio events."""
+    fan_out.add_sink(audio_sinks.MidiPortSink(),
+                     drop_policy=audio_sinks.COALESCE)
 
-    sq = send_sound.Squeaker()
 
-    while True:
-        t_or_n = audio_pipe.recv()
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def audio(audio_pipe, make_sinks=default_sinks):
+    """Forwards notes received between ticks to all audio sinks.
+
+    `make_sinks` is called with the `FanOut` to register sinks; it runs in the
+    audio process so that ports and threads are created there.
+
+    Stops on `AUDIO_STOP`, sent by the main process on shutdown, when the
+    pipe is closed or on SIGTERM, and always closes the sinks so recorders
+    write their files. SIGINT is left to the main process, so notes still in
+    the pipe are delivered before `AUDIO_STOP`."""
+
+    signal.signal(signal.SIGTERM, _exit)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    fan_out = audio_sinks.FanOut()
+    make_sinks(fan_out)
+    notes = []
+
+    try:
+        while True:
+            try:
+                t_or_n = audio_pipe.recv()
+            except EOFError:
+                break
+
+            if t_or_n is AUDIO_STOP:
+                break
 
-        # Is a time stamp.
-        if isinstance(t_or_n, float):
-            sq.tick(t_or_n)
+            # Is a time stamp.
+            if isinstance(t_or_n, float):
+                fan_out.publish(t_or_n, notes)
+                notes = []
 
-        # Is a note.
-        if isinstance(t_or_n, send_sound.Note):
-            print(f'received {t_or_n}')
-            sq.play_note(t_or_n)
+            # Is a note.
+            if isinstance(t_or_n, send_sound.Note):
+                print(f'received {t_or_n}')
+                notes.append(t_or_n)
+    finally:
+        fan_out.close()
 
 
 class AudioRouter(object):
@@ -265,3 +663,16 @@ if __name__ == "__main__":
 
     p_audio.start()
     p_delphi.start()
+    signal.signal(signal.SIGTERM, _exit)
+
+    try:
+        p_delphi.join()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # Stop simulation first so `AUDIO_STOP` is the last message, then
+        # wait for the audio process to close its sinks.
+        p_delphi.terminate()
+        p_delphi.join()
+        parent_conn.send(AUDIO_STOP)
+        p_audio.join()
@@ -3,6 +3,8 @@
 Contains functions to coordinate the various aspects of graph-based music
 generation."""
 
+import bisect
+from operator import itemgetter
 
 import networkx as nx
 import numpy as np
@@ -10,6 +12,10 @@ import numpy as np
 import explorer
 
 
+_END_BEHAVIORS = (explorer.Explorer._BOUNCE, explorer.Explorer._EXPLODE,
+                  explorer.Explorer._RANDOM)
+
+
 def _initialize_graph(nodes, edges, digraph=False):
     G = nx.DiGraph()
     G.add_nodes_from(nodes)
@@ -51,14 +57,137 @@ def add_length(graph, positions, name="length"):
     _add_edge_feature_to_graph(graph, length, name=name)
 
 
+class EdgeOccupancy(object):
+    """Explorers on one edge, sorted by position along the edge.
+
+    Positions are normalized to the orientation of the edge key, so explorers
+    travelling in either direction share one ordering. The sum of positions
+    and a histogram of positions over `bins` equal segments are kept up to
+    date, so aggregates do not need to visit explorers."""
+
+    def __init__(self, bins=1):
+        # Entries are `[position, explorer, forward, bin]`, with their
+        # positions mirrored in `_positions` for bisection and explorer ids in
+        # `_ids` for gathering.
+        self._entries = []
+        self._positions = []
+        self._ids = []
+        self._index = {}
+        self.total = 0.
+        self.bins = [0] * bins
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, i):
+        return self._entries[i][1]
+
+    @property
+    def explorers(self):
+        return [x[1] for x in self._entries]
+
+    @property
+    def positions(self):
+        return list(self._positions)
+
+    def entry(self, i):
+        """Returns `(position, explorer)` of `i`-th explorer."""
+        x = self._entries[i]
+        return x[0], x[1]
+
+    def _bin(self, pos):
+        return min(max(int(pos * len(self.bins)), 0), len(self.bins) - 1)
+
+    def _entry(self, e, forward):
+        pos = e.location if forward else 1 - e.location
+        x = self._index[e] = [pos, e, forward, self._bin(pos)]
+        self.total += pos
+        self.bins[x[3]] += 1
+        return x
+
+    def insert(self, e, forward):
+        x = self._entry(e, forward)
+        i = bisect.bisect_right(self._positions, x[0])
+        self._entries.insert(i, x)
+        self._positions.insert(i, x[0])
+        self._ids.insert(i, e.id)
+
+    def insert_many(self, es, forwards):
+        """Inserts explorers `es`, sorting once rather than per explorer."""
+        entries = self._entries + [
+            self._entry(e, f) for e, f in zip(es, forwards)]
+        # Stable, so explorers at equal positions keep `insert` order.
+        entries.sort(key=itemgetter(0))
+        self._entries = entries
+        self._positions = [x[0] for x in entries]
+        self._ids = [x[1].id for x in entries]
+
+    def remove(self, e):
+        x = self._index.pop(e)
+        i = bisect.bisect_left(self._positions, x[0])
+        while self._entries[i] is not x:
+            i += 1
+        del self._entries[i]
+        del self._positions[i]
+        del self._ids[i]
+        self.total -= x[0]
+        self.bins[x[3]] -= 1
+
+    def update(self):
+        """Updates positions and returns meetings since last update.
+
+        Restores sorted order with an insertion sort; each swap is a pair of
+        explorers passing each other, so cost is proportional to explorers on
+        the edge plus meetings. Returns `(e1, e2, position)` tuples."""
+        entries = self._entries
+        bins = self.bins
+        n_bins = len(bins)
+        old = {id(x[1]): x[0] for x in entries}
+        total = 0.
+        for x in entries:
+            pos = x[0] = x[1].location if x[2] else 1 - x[1].location
+            total += pos
+            # Inlined `_bin`; this loop runs for every explorer each tick.
+            b = int(pos * n_bins)
+            if not 0 <= b < n_bins:
+                b = min(max(b, 0), n_bins - 1)
+            if b != x[3]:
+                bins[x[3]] -= 1
+                bins[b] += 1
+                x[3] = b
+        self.total = total
+
+        meetings = []
+        for i in range(1, len(entries)):
+            j = i
+            while j > 0 and entries[j - 1][0] > entries[j][0]:
+                a, b = entries[j - 1], entries[j]
+                meetings.append((a[1], b[1], _crossing(
+                    old[id(a[1])], a[0], old[id(b[1])], b[0])))
+                entries[j - 1], entries[j] = b, a
+                j -= 1
+        self._positions = [x[0] for x in entries]
+        if meetings:
+            self._ids = [x[1].id for x in entries]
+        return meetings
+
+
+def _crossing(a0, a1, b0, b1):
+    """Position where paths `a0 -> a1` and `b0 -> b1` cross."""
+    gap = (b0 - a0) - (b1 - a1)
+    s = (b0 - a0) / gap if gap else 0
+    return a0 + s * (a1 - a0)
+
+
 class DelphiBase(object):
     """Sound generation on a graph.
 
     Each time step consists of a sequence of actions:
 
     1. Update `Explorer` locations.
-    2. Perform operations associated with Explorers.
-    3. Generate sound.
+    2. Detect explorers meeting on edges.
+    3. Perform operations associated with Explorers.
+    4. Generate sound.
 
     Note that we process all sound events at the end of the time step to ensure
     that they are played simultanously.
@@ -66,12 +195,21 @@ class DelphiBase(object):
 
     _graph: nx.DiGraph = None
     _explorers = None
+    _explorer_ids = None
+    _next_explorer_id = 0
+    _occupancy = None
+    # Number of position bins kept per occupied edge.
+    _occupancy_bins = 1
+    _time = 0.
     _play_queue = None
     _player = None
 
     def __init__(self, graph, player):
         self._graph = graph
-        self._explorers = []
+        # Insertion-ordered set of explorers (values unused).
+        self._explorers = {}
+        self._explorer_ids = {}
+        self._occupancy = {}
         self._play_queue = []
         self._player = player
 
@@ -103,21 +241,155 @@ class DelphiBase(object):
 
     def remove_all_explorers(self):
         """Removes all explorers from graph."""
-        self._explorers = []
-
-    def add_explorer(self, edge, natural_speed=1, **kwargs):
+        self._explorers = {}
+        self._explorer_ids = {}
+        self._occupancy = {}
+        self.set_new_edge_attribute(0, "mite_count")
+
+    def edge_orientation(self, edge):
+        """Returns key of undirected `edge` and whether `edge` runs along it."""
+        a, b = edge
+        return ((a, b), True) if a <= b else ((b, a), False)
+
+    def _edge_occupancy(self, key):
+        occupancy = self._occupancy.get(key)
+        if occupancy is None:
+            occupancy = self._occupancy[key] = EdgeOccupancy(
+                self._occupancy_bins)
+        return occupancy
+
+    def _occupy(self, e):
+        key, forward = self.edge_orientation((e.node_a, e.node_b))
+        self._edge_occupancy(key).insert(e, forward)
+
+    def _occupy_many(self, es):
+        """Occupies edges of `es`, sorting each edge once."""
+        groups = {}
+        for e in es:
+            key, forward = self.edge_orientation((e.node_a, e.node_b))
+            group = groups.setdefault(key, ([], []))
+            group[0].append(e)
+            group[1].append(forward)
+        for key, (group, forwards) in groups.items():
+            self._edge_occupancy(key).insert_many(group, forwards)
+
+    def _vacate(self, e):
+        key, _ = self.edge_orientation((e.node_a, e.node_b))
+        occupancy = self._occupancy[key]
+        occupancy.remove(e)
+        if not len(occupancy):
+            del self._occupancy[key]
+
+    def _occupancy_columns(self, keys):
+        """Returns ids, positions and counts of explorers on edges `keys`.
+
+        Ids and positions are lists grouped by edge in the order of `keys`;
+        they are concatenated from per-edge lists without visiting explorers.
+        """
+        ids, positions, counts = [], [], []
+        for k in keys:
+            occupancy = self._occupancy[k]
+            ids.extend(occupancy._ids)
+            positions.extend(occupancy._positions)
+            counts.append(len(occupancy))
+        return ids, positions, counts
+
+    def remove_edge_explorers(self, edge):
+        """Removes all explorers on undirected `edge` and returns them.
+
+        Drops the edge's occupancy at once instead of vacating explorers one
+        by one."""
+        key, _ = self.edge_orientation(edge)
+        occupancy = self._occupancy.pop(key, None)
+        if occupancy is None:
+            return []
+        orphans = occupancy.explorers
+        for e in orphans:
+            self._forget_explorer(e)
+        return orphans
+
+    def edge_explorers(self, edge):
+        """Returns explorers on undirected `edge` sorted by position."""
+        key, _ = self.edge_orientation(edge)
+        occupancy = self._occupancy.get(key)
+        return occupancy.explorers if occupancy else []
+
+    def add_explorer(self, edge, natural_speed=1, explorer_id=None, **kwargs):
+        """Adds explorer to `edge` and returns its id.
+
+        Explorers continuing the path of another explorer (e.g. on bounce)
+        pass its `explorer_id` so the id stays stable over the path."""
+        e = self._new_explorer(edge, natural_speed, explorer_id, **kwargs)
+        self._occupy(e)
+        return e.id
+
+    def _new_explorer(self, edge, natural_speed, explorer_id=None, **kwargs):
+        """Creates and registers explorer without placing it on its edge."""
         edge_speed = self.edge_speed(edge)
 
+        if explorer_id is None:
+            explorer_id = self._next_explorer_id
+            self._next_explorer_id += 1
+
         # total speed is combination of mite speed and factor accounting for edge length.
         e = explorer.Explorer(
-            edge, edge_speed * natural_speed, natural_speed, **kwargs)
-        self._explorers.append(e)
+            edge, edge_speed * natural_speed, natural_speed,
+            explorer_id=explorer_id, **kwargs)
+        self._explorers[e] = None
+        self._explorer_ids[explorer_id] = e
         self.graph[edge[0]][edge[1]]["mite_count"] = self.graph[edge[0]
                                                                 ][edge[1]]["mite_count"] + 1
         self.graph[edge[1]][edge[0]]["mite_count"] = self.graph[edge[1]
                                                                 ][edge[0]]["mite_count"] + 1
-
-    def edge_speed(self):
+        return e
+
+    def add_explorers(self, edges, natural_speed=1,
+                      end_behavior=explorer.Explorer._BOUNCE):
+        """Adds batch of explorers and returns their ids.
+
+        `natural_speed` and `end_behavior` are scalars or one value per edge.
+        The whole batch is validated before any explorer is added."""
+        edges = np.asarray(edges)
+        if not len(edges):
+            return []
+        if edges.ndim != 2 or edges.shape[1] != 2:
+            raise ValueError("`edges` must be pairs of nodes.")
+        natural_speed = np.broadcast_to(
+            np.asarray(natural_speed, dtype=float), (len(edges),))
+        end_behavior = np.broadcast_to(
+            np.asarray(end_behavior, dtype=int), (len(edges),))
+
+        if not np.all(np.isfinite(natural_speed) & (natural_speed >= 0)):
+            raise ValueError("Invalid speed.")
+        if not np.all(np.isin(end_behavior, _END_BEHAVIORS)):
+            raise ValueError("Invalid end behavior.")
+        edges = edges.tolist()
+        missing = [e for e in edges if not self.graph.has_edge(*e)]
+        if missing:
+            raise ValueError(f"Invalid edges {missing[:5]}.")
+
+        es = [self._new_explorer(e, s, end_behavior=eb) for e, s, eb in zip(
+            edges, natural_speed.tolist(), end_behavior.tolist())]
+        self._occupy_many(es)
+        return [e.id for e in es]
+
+    def remove_explorers(self, explorer_ids):
+        """Removes explorers by id and returns ids that were removed."""
+        removed = [self._explorer_ids[i] for i in set(explorer_ids)
+                   if i in self._explorer_ids]
+        for e in removed:
+            self.remove_explorer(e)
+        return [e.id for e in removed]
+
+    def explorer_ids(self):
+        """Returns ids of explorers, in the order of `explorer_position`."""
+        return [e.id for e in self._explorers]
+
+    def query_explorers(self, explorer_ids):
+        """Returns explorers with given ids; `None` for unknown ids."""
+        return [self._explorer_ids.get(i) for i in explorer_ids]
+
+    def edge_speed(self, edge):
         """Default speed for explorer."""
         return 1
 
@@ -136,9 +408,14 @@ class DelphiBase(object):
         return [e.location for e in self._explorers]
 
     def update(self, dt):
+        self._time += dt
+
         # Update locations of players.
         self.update_explorers(dt)
 
+        # Trigger meetings of players passing each other.
+        self.detect_meetings()
+
         # Perform position-specific operations on players.
         self.operate_explorers()
 
@@ -149,14 +426,29 @@ class DelphiBase(object):
         """Updates locations of explorers."""
         [e.update_location(dt) for e in self._explorers]
 
+    def detect_meetings(self):
+        """Calls `explorer_meet` for explorers that crossed since last step."""
+        for key, occupancy in list(self._occupancy.items()):
+            for e1, e2, position in occupancy.update():
+                self.explorer_meet(e1, e2, key, position)
+
     def remove_explorer(self, e):
+        self._vacate(e)
+        self._forget_explorer(e)
+
+    def _forget_explorer(self, e):
+        """Unregisters explorer `e` that no longer occupies its edge."""
         self.graph[e.node_a][e.node_b]["mite_count"] = self.graph[e.node_a][e.node_b]["mite_count"] - 1
         self.graph[e.node_b][e.node_a]["mite_count"] = self.graph[e.node_b][e.node_a]["mite_count"] - 1
-        self._explorers.remove(e)
+        del self._explorers[e]
+        # Id may already belong to explorer continuing the path of `e`.
+        if self._explorer_ids.get(e.id) is e:
+            del self._explorer_ids[e.id]
 
     def operate_explorers(self):
         """Defines operation of `Explorer` based on location."""
-        for e in self._explorers:
+        # Iterate over copy since operations add and remove explorers.
+        for e in list(self._explorers):
             if e.at_start:
                 self.explorer_at_start(e, e.node_a)
             if e.at_end:
@@ -168,6 +460,9 @@ class DelphiBase(object):
     def explorer_at_end(self, e, node):
         """Defines behavior when explorer is at end node."""
 
+    def explorer_meet(self, e1, e2, edge, position):
+        """Defines behavior when explorers meet at `position` along `edge`."""
+
     def play_node(self, node):
         """Defines behaviour for playing node."""
 
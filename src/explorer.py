@@ -12,13 +12,16 @@ class Explorer(object):
     _speed = None
     _natural_speed = None
     _location = None
+    _id = None
     _at_start = False
     _at_end = False
     _BOUNCE = 0
     _EXPLODE = 1
     _RANDOM = 2
 
-    def __init__(self, edge, speed, natural_speed, location=0, end_behavior=_BOUNCE):
+    def __init__(self, edge, speed, natural_speed, location=0, end_behavior=_BOUNCE,
+                 explorer_id=None):
+        self._id = explorer_id
         self._edge = edge
         self._a = edge[0]
         self._b = edge[1]
@@ -29,6 +32,10 @@ class Explorer(object):
         if self.location == 0:
             self._at_start = True
 
+    @property
+    def id(self):
+        return self._id
+
     @property
     def node_a(self):
         return self._a
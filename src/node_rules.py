@@ -0,0 +1,200 @@
+"""Per-node rules deciding whether an arrival plays a note.
+
+Rule parameters and state live in NumPy arrays with one row per node, so all
+arrivals of a time step are checked in one vectorized pass."""
+
+import numpy as np
+
+
+# Arrival times kept per node before any threshold asks for more.
+_HISTORY = 8
+
+
+class NodeRules(object):
+    """Cooldowns, arrival counters and thresholds of nodes.
+
+    A node fires at most once per step, and only if all rules pass:
+
+    - `cooldown`: seconds since the node last fired.
+    - `every_n`: the node's arrival counter passed a multiple of `every_n`
+      during the step. Every arrival counts, including suppressed ones.
+    - `threshold`: number of arrivals at the node within the last `window`
+      seconds, including the current step. A `window` of 0 only counts
+      arrivals of the current step.
+
+    Defaults (0, 1, 1, 0) fire on every step with an arrival. Times are
+    simulation times, as for `cooldown`. The last `max(8, threshold)`
+    arrival times of each node are kept, so raising a threshold above that
+    only counts arrivals from then on.
+    """
+
+    def __init__(self, nodes=()):
+        self._rows = {}
+        self._nodes = []
+        self._size = 0
+        capacity = max(len(nodes), 16)
+        self._cooldown = np.zeros(capacity)
+        self._every_n = np.ones(capacity, dtype=np.int64)
+        self._threshold = np.ones(capacity, dtype=np.int64)
+        self._window = np.zeros(capacity)
+        self._last_fired = np.full(capacity, -np.inf)
+        self._count = np.zeros(capacity, dtype=np.int64)
+        # Times of the last arrivals of each node; arrival number `i` is kept
+        # in column `i % columns`. Columns cover the largest threshold.
+        self._recent = np.full((capacity, _HISTORY), -np.inf)
+        for n in nodes:
+            self.add(n)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, node):
+        return node in self._rows
+
+    def _grow(self):
+        self._cooldown = np.concatenate([self._cooldown, np.zeros_like(
+            self._cooldown)])
+        self._every_n = np.concatenate([self._every_n, np.ones_like(
+            self._every_n)])
+        self._threshold = np.concatenate([self._threshold, np.ones_like(
+            self._threshold)])
+        self._window = np.concatenate([self._window, np.zeros_like(
+            self._window)])
+        self._last_fired = np.concatenate([self._last_fired, np.full_like(
+            self._last_fired, -np.inf)])
+        self._count = np.concatenate([self._count, np.zeros_like(
+            self._count)])
+        self._recent = np.concatenate([self._recent, np.full_like(
+            self._recent, -np.inf)])
+
+    def _widen(self, columns):
+        """Keeps the last `columns` arrival times of each node."""
+        old = self._recent.shape[1]
+        if columns <= old:
+            return
+        recent = np.full((len(self._recent), columns), -np.inf)
+        last = self._count[:, None] - 1 - np.arange(old)[None, :]
+        rows = np.arange(len(self._recent))[:, None]
+        recent[rows, last % columns] = self._recent[rows, last % old]
+        self._recent = recent
+
+    def add(self, node):
+        """Adds `node` with default rules."""
+        if node in self._rows:
+            return
+        if self._size == len(self._count):
+            self._grow()
+        row = self._size
+        self._rows[node] = row
+        self._nodes.append(node)
+        self._cooldown[row] = 0
+        self._every_n[row] = 1
+        self._threshold[row] = 1
+        self._window[row] = 0
+        self._last_fired[row] = -np.inf
+        self._count[row] = 0
+        self._recent[row] = -np.inf
+        self._size += 1
+
+    def remove(self, node):
+        """Removes `node`, moving the last row into its place."""
+        row = self._rows.pop(node)
+        last = self._size - 1
+        if row != last:
+            moved = self._nodes[last]
+            for a in (self._cooldown, self._every_n, self._threshold,
+                      self._window, self._last_fired, self._count,
+                      self._recent):
+                a[row] = a[last]
+            self._nodes[row] = moved
+            self._rows[moved] = row
+        self._nodes.pop()
+        self._size -= 1
+
+    def set(self, nodes, cooldown=None, every_n=None, threshold=None,
+            window=None):
+        """Sets rules of `nodes`; values are scalars or one per node."""
+        rows = np.array([self._rows[n] for n in nodes], dtype=np.int64)
+        if cooldown is not None:
+            cooldown = np.broadcast_to(np.asarray(cooldown, dtype=float),
+                                       rows.shape)
+            if np.any(cooldown < 0):
+                raise ValueError("`cooldown` must be non-negative.")
+            self._cooldown[rows] = cooldown
+        if every_n is not None:
+            every_n = np.broadcast_to(np.asarray(every_n, dtype=np.int64),
+                                      rows.shape)
+            if np.any(every_n < 1):
+                raise ValueError("`every_n` must be at least 1.")
+            self._every_n[rows] = every_n
+        if threshold is not None:
+            threshold = np.broadcast_to(np.asarray(threshold, dtype=np.int64),
+                                        rows.shape)
+            if np.any(threshold < 1):
+                raise ValueError("`threshold` must be at least 1.")
+            self._widen(int(threshold.max(initial=1)))
+            self._threshold[rows] = threshold
+        if window is not None:
+            window = np.broadcast_to(np.asarray(window, dtype=float),
+                                     rows.shape)
+            if np.any(window < 0):
+                raise ValueError("`window` must be non-negative.")
+            self._window[rows] = window
+
+    def copy(self):
+        """Returns independent copy of rules and their state."""
+        other = NodeRules()
+        other._rows = dict(self._rows)
+        other._nodes = list(self._nodes)
+        other._size = self._size
+        other._cooldown = self._cooldown.copy()
+        other._every_n = self._every_n.copy()
+        other._threshold = self._threshold.copy()
+        other._window = self._window.copy()
+        other._last_fired = self._last_fired.copy()
+        other._count = self._count.copy()
+        other._recent = self._recent.copy()
+        return other
+
+    def reset(self):
+        """Clears counters and firing times."""
+        self._last_fired[:] = -np.inf
+        self._count[:] = 0
+        self._recent[:] = -np.inf
+
+    def fire(self, nodes, t):
+        """Returns nodes among `nodes` arriving at time `t` that fire.
+
+        Updates counters, arrival and firing times. Fired nodes are returned
+        once each, in order of their first arrival."""
+        if not nodes:
+            return []
+        rows = np.fromiter((self._rows[n] for n in nodes), dtype=np.int64,
+                           count=len(nodes))
+        rows, first, arrivals = np.unique(
+            rows, return_index=True, return_counts=True)
+
+        before = self._count[rows]
+        after = before + arrivals
+        self._count[rows] = after
+
+        # Record this step's arrivals; only the last `columns` are kept.
+        columns = self._recent.shape[1]
+        kept = np.minimum(arrivals, columns)
+        starts = np.repeat(after - kept, kept)
+        offsets = np.arange(kept.sum()) - np.repeat(np.cumsum(kept) - kept,
+                                                    kept)
+        self._recent[np.repeat(rows, kept), (starts + offsets) % columns] = t
+
+        # Time of the `threshold`-th most recent arrival.
+        threshold = self._threshold[rows]
+        nth = self._recent[rows, (after - threshold) % columns]
+
+        every_n = self._every_n[rows]
+        fired = ((after // every_n > before // every_n) &
+                 (after >= threshold) &
+                 (t - nth <= self._window[rows]) &
+                 (t - self._last_fired[rows] >= self._cooldown[rows]))
+        self._last_fired[rows[fired]] = t
+
+        return [nodes[i] for i in np.sort(first[fired]).tolist()]
@@ -0,0 +1,92 @@
+"""Previews upcoming notes by propagating explorer arrival times.
+
+For deterministic end behaviors (`_BOUNCE`, `_EXPLODE`) future notes follow
+from current explorer locations, edge speeds and graph topology alone. Arrivals
+are expanded in time order from a priority queue, Dijkstra style, while
+tracking edge occupancy the same way `mite_count` does during a run. Arrivals
+are grouped into simulation steps and checked against a copy of the node
+rules, so only notes that would actually play are returned."""
+
+import heapq
+import itertools
+import math
+
+import explorer
+
+
+def _edge_key(a, b):
+    return (a, b) if a <= b else (b, a)
+
+
+def upcoming_notes(delphi, horizon, time_scale=1., max_events=1000,
+                   dt=1 / 50):
+    """Returns list of `(time, node, note)` notes within `horizon` seconds.
+
+    `time_scale` is the factor applied to wall time when updating `delphi`
+    (i.e. the global speed) and `dt` the wall time between updates. Explorers
+    with `_RANDOM` end behavior contribute their next arrival but are not
+    followed further since their successor is not known in advance. Notes of
+    meetings are not previewed.
+    """
+    graph = delphi.graph
+    if time_scale <= 0:
+        return []
+
+    # Explorers on each undirected edge, as counted by `mite_count`.
+    occupancy = {}
+    queue = []
+    count = itertools.count()
+
+    def push(t, a, b, natural_speed, end_behavior, location=0):
+        speed = delphi.edge_speed((a, b)) * natural_speed
+        occupancy[_edge_key(a, b)] = occupancy.get(_edge_key(a, b), 0) + 1
+        if speed <= 0:
+            return
+        arrival = t + (1 - location) / speed / time_scale
+        if arrival <= horizon:
+            heapq.heappush(queue, (arrival, next(count), a, b,
+                                   natural_speed, end_behavior))
+
+    for e in delphi._explorers:
+        push(0, e.node_a, e.node_b, e._natural_speed, e.end_behavior,
+             location=e.location)
+
+    # Rules are applied to a copy, leaving `delphi` untouched.
+    rules = delphi._node_rules.copy()
+    events = []
+    batch = []
+    step = 0
+
+    def fire():
+        """Adds first arrival of each node in `batch` whose rules fire."""
+        fired = set(rules.fire([n for _, n in batch],
+                               delphi._time + step * dt * time_scale))
+        for t, n in batch:
+            if n in fired:
+                fired.discard(n)
+                events.append((t, n, int(graph.nodes[n]['note'])))
+        batch.clear()
+
+    while queue and len(events) < max_events:
+        t, _, a, b, natural_speed, end_behavior = heapq.heappop(queue)
+
+        # Arrivals are handled at the first update after they happen.
+        if batch and math.ceil(t / dt) != step:
+            fire()
+        step = math.ceil(t / dt)
+        batch.append((t, b))
+
+        # Spawn successors while arriving explorer still occupies its edge.
+        # They start from the node at that update, like during a run.
+        if end_behavior == explorer.Explorer._BOUNCE:
+            push(step * dt, b, a, natural_speed, end_behavior)
+        if end_behavior == explorer.Explorer._EXPLODE:
+            for n in list(graph[b]):
+                if occupancy.get(_edge_key(b, n), 0) < 1:
+                    push(step * dt, b, n, natural_speed, end_behavior)
+
+        occupancy[_edge_key(a, b)] -= 1
+
+    if batch:
+        fire()
+    return events[:max_events]
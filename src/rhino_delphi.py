@@ -1,16 +1,34 @@
 """SoundNetwork for Grasshopper."""
 
 import delphi_base
+import node_rules
 
 import send_sound
+import spatial_index
+import trails
 
 from operator import itemgetter
 import random
 
+import numpy as np
+
 
 _FORWARD = 0
 _REVERSE = 1
 
+# Rules for explorers on removed edges.
+_RETIRE = 0
+_MIGRATE = 1
+
+# Number of points sampled along each edge curve for spatial queries.
+_EDGE_SAMPLES = 16
+
+# Level of detail of `state_lod`.
+LOD_POINTS = 0
+LOD_EDGES = 1
+LOD_GRID = 2
+LOD_SAMPLE = 3
+
 
 def _feature_dict(key, data):
     """Generates dict with key from `edge` tuple and data as entry."""
@@ -29,18 +47,114 @@ def map_dict_items(f, my_dictionary):
     return {k: f(v) for k, v in my_dictionary.items()}
 
 
+def _xyz(point):
+    """Converts Rhino point to array."""
+    return np.array([point.X, point.Y, point.Z], dtype=float)
+
+
+def _sample_curve(curve, n=_EDGE_SAMPLES):
+    """Samples `curve` at `n` evenly spaced parameters in [0, 1]."""
+    return np.array([_xyz(curve.PointAt(t)) for t in np.linspace(0, 1, n)])
+
+
+def _interpolate(samples, loc):
+    """Linearly interpolates point at `loc` in [0, 1] along `samples`."""
+    x = loc * (len(samples) - 1)
+    i = min(int(x), len(samples) - 2)
+    f = x - i
+    return samples[i] * (1 - f) + samples[i + 1] * f
+
+
+def _interpolate_many(stack, rows, locs):
+    """Vectorized `_interpolate` of `locs` along sampled curves `stack[rows]`."""
+    x = locs * (stack.shape[1] - 1)
+    i = np.clip(x.astype(np.int64), 0, stack.shape[1] - 2)
+    f = (x - i)[:, None]
+    return stack[rows, i] * (1 - f) + stack[rows, i + 1] * f
+
+
+def snapshot_points(snapshot):
+    """Returns `(ids, points)` of snapshot from `Delphi.explorer_snapshot`."""
+    ids, stack, rows, locs = snapshot
+    return ids, _interpolate_many(stack, rows, locs).tolist()
+
+
+def snapshot_in_region(snapshot, corner_a, corner_b):
+    """Returns sorted ids of snapshot explorers inside box.
+
+    Explorers move every step, so rather than keeping them in a spatial index
+    all positions are tested at once with NumPy; take the snapshot under the
+    simulation lock and call this after releasing it."""
+    ids, stack, rows, locs = snapshot
+    points = _interpolate_many(stack, rows, locs)
+    lo = np.minimum(_xyz(corner_a), _xyz(corner_b))
+    hi = np.maximum(_xyz(corner_a), _xyz(corner_b))
+    inside = np.all((points >= lo) & (points <= hi), axis=-1)
+    return sorted(ids[i] for i in np.flatnonzero(inside).tolist())
+
+
 class Delphi(delphi_base.DelphiBase):
     """Adds functionality for interacting with Rhino."""
 
+    _node_grid = None
+    _edge_grid = None
+    _sample_stack = None
+    _edge_rows = None
+    _free_rows = None
+    _edges = None
+    _edge_ids = None
+    _edge_keys = None
+    _trails = None
+    _node_rules = None
+    _arrivals = None
+    # Histogram explorer positions per curve segment, see `state_lod`.
+    _occupancy_bins = _EDGE_SAMPLES - 1
+    orphan_rule = _RETIRE
+    play_meetings = False
+
+    def __init__(self, graph, player):
+        super().__init__(graph, player)
+        self._reset_spatial_index()
+        self._edge_ids = {}
+        self._edge_keys = []
+        self._node_rules = node_rules.NodeRules()
+        self._arrivals = []
+
+    @property
+    def _init_edges(self):
+        """Edges in the direction their curves run, in order of addition."""
+        return [list(e) for e in self._edges]
+
     def set_up(self, nodes, edges):
         """Sets up G with additional edge/node features for performance."""
-        self._init_edges = edges
+        # Ordered set of edges, so single edges are removed in O(1).
+        self._edges = dict.fromkeys(tuple(e) for e in edges)
+        self._edge_ids = {}
+        self._edge_keys = []
+        if self._trails is not None:
+            self.enable_trails(self._trails.length)
 
         self.graph = delphi_base._initialize_graph(
             nodes, edges, digraph=True)
+        # Includes nodes that only appear in `edges`.
+        self._node_rules = node_rules.NodeRules(list(self.graph.nodes))
 
         self.set_new_edge_attribute(False, "edge_played")
         self.set_new_edge_attribute(0, "mite_count")
+        if edges:
+            self.set_new_edge_attribute(
+                _feature_dict(edges, [_FORWARD] * len(edges)), 'curve_direction')
+            self.set_new_edge_attribute(
+                _feature_dict(reverse_edges(edges), [_REVERSE] * len(edges)), 'curve_direction')
+        self._reset_spatial_index()
+
+    def _reset_spatial_index(self, cell_size=1.0):
+        """Clears spatial indexes of nodes and edges."""
+        self._node_grid = spatial_index.GridIndex(cell_size)
+        self._edge_grid = spatial_index.GridIndex(cell_size, polyline=True)
+        self._sample_stack = np.full((16, _EDGE_SAMPLES, 3), np.nan)
+        self._edge_rows = {}
+        self._free_rows = list(range(15, -1, -1))
 
     def update_geometry(self, edge_curve):
         # Add curves going in each direction.
@@ -58,6 +172,250 @@ class Delphi(delphi_base.DelphiBase):
         self.set_new_edge_attribute(
             _feature_dict(reversed_edges, [_REVERSE] * len(reversed_edges)), 'curve_direction')
 
+        self._index_geometry(edges, edge_curve)
+
+    def _index_geometry(self, edges, edge_curve):
+        """Updates spatial indexes of nodes and edge curves.
+
+        Edges are keyed in the orientation of `_init_edges`, i.e. the
+        direction in which their curve runs forward. Only grid cells of
+        geometry that actually moved are touched."""
+        samples = [_sample_curve(c) for c in edge_curve]
+
+        if not len(self._edge_grid) and samples:
+            # Size grid cells by typical edge length on first use.
+            lengths = [np.linalg.norm(s[-1] - s[0]) for s in samples]
+            cell_size = np.median(lengths)
+            self._reset_spatial_index(cell_size if cell_size > 0 else 1.0)
+
+        for e, s in zip(edges, samples):
+            e = tuple(e)
+            self._store_samples(e, s)
+            self._edge_grid.move(e, s)
+            self._node_grid.move(e[0], s[0])
+            self._node_grid.move(e[1], s[-1])
+
+    def node_positions(self):
+        """Returns array of node positions indexed by node.
+
+        Suitable as `positions` argument of `delphi_base.add_length`."""
+        nodes = list(self._node_grid.keys())
+        positions = np.full((max(nodes, default=-1) + 1, 3), np.nan)
+        for n in nodes:
+            positions[n] = self._node_grid.points(n)[0]
+        return positions
+
+    def edge_orientation(self, edge):
+        """Keys edges in the direction in which their curve runs."""
+        a, b = edge
+        if self.graph[a][b]["curve_direction"] == _FORWARD:
+            return (a, b), True
+        return (b, a), False
+
+    def _canonical_location(self, e):
+        """Returns edge in curve direction and location of `e` along it."""
+        edge, forward = self.edge_orientation((e.node_a, e.node_b))
+        return edge, e.location if forward else 1 - e.location
+
+    def _explorer_point(self, e):
+        """Approximates position of `e` from sampled edge curve."""
+        edge, loc = self._canonical_location(e)
+        return _interpolate(self._sample_stack[self._edge_rows[edge]], loc)
+
+    def _store_samples(self, key, samples):
+        """Writes samples of edge `key` to its row of the sample stack."""
+        row = self._edge_rows.get(key)
+        if row is None:
+            if not self._free_rows:
+                n = len(self._sample_stack)
+                self._sample_stack = np.concatenate(
+                    [self._sample_stack, np.full_like(self._sample_stack,
+                                                      np.nan)])
+                self._free_rows.extend(range(2 * n - 1, n - 1, -1))
+            row = self._edge_rows[key] = self._free_rows.pop()
+        self._sample_stack[row] = samples
+
+    def _drop_samples(self, key):
+        """Frees row of edge `key` in the sample stack."""
+        row = self._edge_rows.pop(key, None)
+        if row is not None:
+            self._sample_stack[row] = np.nan
+            self._free_rows.append(row)
+
+    def _stacked_samples(self):
+        """Returns sampled edge curves as one array and row of each edge.
+
+        Rows are written in place as edges are added, moved or removed; rows
+        of removed edges are NaN until reused."""
+        return self._sample_stack, self._edge_rows
+
+    def state_lod(self, mode=LOD_EDGES, k=1000, resolution=32):
+        """Returns aggregated state as `(points, values)`.
+
+        `LOD_POINTS`: explorer positions, values are explorer ids.
+        `LOD_EDGES`: mean explorer position per occupied edge, values are
+        explorer counts.
+        `LOD_GRID`: centers of occupied cells of a grid with `resolution`
+        cells along each axis of the scene bounds, values are counts.
+        `LOD_SAMPLE`: at most `k` explorers sampled evenly across edges and
+        positions, values are explorer ids.
+
+        Except for `LOD_POINTS`, aggregates are computed from per-edge counts,
+        position sums and segment histograms that `EdgeOccupancy` keeps up to
+        date, so their cost grows with the number of occupied edges (plus `k`)
+        rather than with the number of explorers. `LOD_GRID` places explorers
+        at the midpoint of the curve segment they are on. Explorers on edges
+        without sampled geometry are left out. Points are arrays except for
+        `LOD_POINTS`, which evaluates curves like `state`.
+        """
+        if mode == LOD_POINTS:
+            return self.state(), [e.id for e in self._explorers]
+
+        stack, edge_rows = self._stacked_samples()
+        keys = [k for k in self._occupancy if k in edge_rows]
+        occupancy = [self._occupancy[k] for k in keys]
+        rows = np.array([edge_rows[k] for k in keys], dtype=np.int64)
+        counts = np.array([len(o) for o in occupancy], dtype=np.int64)
+
+        if mode == LOD_EDGES:
+            totals = np.array([o.total for o in occupancy], dtype=float)
+            means = totals / np.maximum(counts, 1)
+            return _interpolate_many(stack, rows, means), counts
+
+        if mode == LOD_GRID:
+            if not len(keys):
+                return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+            weights = np.array([o.bins for o in occupancy], dtype=float)
+            midpoints = (stack[rows, :-1] + stack[rows, 1:]) / 2
+            lo = np.nanmin(stack.reshape(-1, 3), axis=0)
+            hi = np.nanmax(stack.reshape(-1, 3), axis=0)
+            bins = np.where(hi > lo, resolution, 1)
+            hist, edges = np.histogramdd(
+                midpoints.reshape(-1, 3), bins=bins, weights=weights.ravel(),
+                range=list(zip(lo, np.maximum(hi, lo + 1))))
+            occupied = np.nonzero(hist)
+            centers = np.stack([(e[i] + e[i + 1]) / 2
+                                for e, i in zip(edges, occupied)], axis=-1)
+            return centers, np.round(hist[occupied]).astype(np.int64)
+
+        if mode == LOD_SAMPLE:
+            n = int(counts.sum())
+            pick = ((np.arange(min(k, n)) + 0.5) * n / max(min(k, n), 1)
+                    ).astype(np.int64)
+            # Locate picked explorers by edge and offset along edge.
+            ends = np.cumsum(counts)
+            edge = np.searchsorted(ends, pick, side='right')
+            offset = pick - (ends - counts)[edge]
+            picked = [occupancy[i].entry(j)
+                      for i, j in zip(edge.tolist(), offset.tolist())]
+            locs = np.array([loc for loc, _ in picked], dtype=float)
+            ids = [e.id for _, e in picked]
+            return _interpolate_many(stack, rows[edge], locs), ids
+
+        raise ValueError(f"Invalid level of detail {mode}.")
+
+    def enable_trails(self, length):
+        """Records trails of the last `length` steps; 0 disables trails."""
+        self._trails = trails.TrailBuffer(length) if length > 0 else None
+        if self._trails is not None:
+            for i in self._explorer_ids:
+                self._trails.acquire(i)
+
+    def _new_explorer(self, edge, natural_speed, explorer_id=None, **kwargs):
+        e = super()._new_explorer(edge, natural_speed, explorer_id, **kwargs)
+        # Successors keep the trail of the explorer they continue.
+        if self._trails is not None:
+            self._trails.acquire(e.id)
+        return e
+
+    def _forget_explorer(self, e):
+        retired = self._explorer_ids.get(e.id) is e
+        super()._forget_explorer(e)
+        if retired and self._trails is not None:
+            self._trails.release(e.id)
+
+    def remove_all_explorers(self):
+        super().remove_all_explorers()
+        if self._trails is not None:
+            self._trails.clear()
+
+    def _edge_id(self, key):
+        """Returns id of edge `key` that stays fixed until `set_up`."""
+        i = self._edge_ids.get(key)
+        if i is None:
+            i = self._edge_ids[key] = len(self._edge_keys)
+            self._edge_keys.append(key)
+        return i
+
+    def update(self, dt):
+        super().update(dt)
+        if self._trails is not None:
+            self._record_trails()
+
+    def _record_trails(self):
+        keys = list(self._occupancy)
+        ids, locs, counts = self._occupancy_columns(keys)
+        edges = np.repeat(np.array([self._edge_id(k) for k in keys],
+                                   dtype=np.int64), counts)
+        self._trails.record(np.array(self._trails.slots(ids), dtype=np.int64),
+                            edges, np.array(locs, dtype=float))
+
+    def trails(self, ids=None):
+        """Returns `(ids, counts, points)` of explorer trails.
+
+        `points` holds the trails of all explorers one after another, oldest
+        point first; `counts` is the number of points of each trail."""
+        if self._trails is None:
+            return [], np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+        ids, edges, locs, counts = self._trails.query(ids)
+        stack, edge_rows = self._stacked_samples()
+
+        # Drop unrecorded entries and entries on edges without geometry.
+        lookup = np.array([edge_rows.get(k, -1) for k in self._edge_keys] + [-1],
+                          dtype=np.int64)
+        rows = lookup[np.where(edges >= 0, edges, -1)]
+        valid = (np.arange(self._trails.length)[None, :] >=
+                 (self._trails.length - counts)[:, None]) & (rows >= 0)
+        points = _interpolate_many(stack, rows[valid], locs[valid])
+        return ids, valid.sum(axis=1), points
+
+    def explorer_snapshot(self):
+        """Copies ids, edges and positions of explorers.
+
+        Only collects what is needed to locate explorers later, so it is cheap
+        to take while holding the simulation lock; `snapshot_points` turns it
+        into points afterwards. Explorers on edges without sampled geometry
+        are left out."""
+        stack, edge_rows = self._stacked_samples()
+        keys = [k for k in self._occupancy if k in edge_rows]
+        ids, locs, counts = self._occupancy_columns(keys)
+        locs = np.array(locs, dtype=float)
+        rows = np.repeat(np.array([edge_rows[k] for k in keys],
+                                  dtype=np.int64), counts)
+        return ids, stack, rows, locs
+
+    def explorer_points(self):
+        """Returns ids and approximate positions of explorers.
+
+        Positions are interpolated from sampled edge curves, which is much
+        cheaper than evaluating curves as `state` does."""
+        return snapshot_points(self.explorer_snapshot())
+
+    def nearest_node(self, point):
+        """Returns `(node, distance)` of node nearest to Rhino `point`."""
+        return self._node_grid.nearest(_xyz(point))
+
+    def nearest_edge(self, point):
+        """Returns `(edge, distance)` of edge curve nearest to Rhino `point`.
+
+        Distance is measured to the polyline through the curve samples."""
+        return self._edge_grid.nearest(_xyz(point))
+
+    def explorers_in_region(self, corner_a, corner_b):
+        """Returns ids of explorers inside box, see `snapshot_in_region`."""
+        return snapshot_in_region(
+            self.explorer_snapshot(), corner_a, corner_b)
+
     def add_edge_data(self, edges, edge_data, edge_data_names):
         """Adds data associated with edges."""
         reversed_edges = reverse_edges(edges)
@@ -74,6 +432,91 @@ class Delphi(delphi_base.DelphiBase):
         for nd, name in zip(node_data, node_data_names):
             self.set_new_node_attribute(_feature_dict(nodes, nd), name)
 
+    def add_node(self, node, **data):
+        """Adds `node` with node attributes `data`."""
+        if node in self.graph:
+            raise ValueError(f"Node {node} exists.")
+        self.graph.add_node(node, **data)
+        self._node_rules.add(node)
+
+    def remove_node(self, node, rule=None):
+        """Removes `node` and its edges.
+
+        Explorers on removed edges are handled according to `rule`; migrated
+        explorers restart from the other end of their edge."""
+        rule = self.orphan_rule if rule is None else rule
+        orphans = []
+        for n in list(self.graph[node]):
+            orphans.extend(self.edge_explorers((node, n)))
+            self.remove_edge((node, n), _RETIRE)
+        self.graph.remove_node(node)
+        self._node_rules.remove(node)
+        if node in self._node_grid:
+            self._node_grid.remove(node)
+
+        if rule == _MIGRATE:
+            for e in orphans:
+                self._migrate_explorer(
+                    e, e.node_b if e.node_a == node else e.node_a)
+
+    def add_edge(self, edge, curve=None, **data):
+        """Adds `edge` in both directions with edge attributes `data`.
+
+        `edge` is oriented in the direction in which `curve` runs."""
+        a, b = edge
+        if a not in self.graph or b not in self.graph:
+            raise ValueError(f"Unknown node in edge {edge}.")
+        if self.graph.has_edge(a, b):
+            raise ValueError(f"Edge {edge} exists.")
+
+        for u, v, direction in [(a, b, _FORWARD), (b, a, _REVERSE)]:
+            self.graph.add_edge(u, v, edge_played=False, mite_count=0,
+                                curve_direction=direction, **data)
+            if curve is not None:
+                self.graph[u][v]['edge_curve'] = curve
+        self._edges[(a, b)] = None
+
+        if curve is not None:
+            self._index_geometry([edge], [curve])
+
+    def remove_edge(self, edge, rule=None):
+        """Removes `edge` in both directions.
+
+        Explorers on the edge are retired (`_RETIRE`) or restarted from the
+        node they left on another edge (`_MIGRATE`) if one is free. `rule`
+        defaults to `orphan_rule`."""
+        a, b = edge
+        if not self.graph.has_edge(a, b):
+            raise ValueError(f"Unknown edge {edge}.")
+        rule = self.orphan_rule if rule is None else rule
+
+        orphans = self.remove_edge_explorers(edge)
+
+        key, _ = self.edge_orientation(edge)
+        self.graph.remove_edge(a, b)
+        self.graph.remove_edge(b, a)
+        self._edges.pop((a, b), None)
+        self._edges.pop((b, a), None)
+        self._drop_samples(key)
+        if key in self._edge_grid:
+            self._edge_grid.remove(key)
+
+        if rule == _MIGRATE:
+            for e in orphans:
+                self._migrate_explorer(e)
+
+    def _migrate_explorer(self, e, node=None):
+        """Restarts `e` from `node` (default: its start node) on the least
+        occupied edge."""
+        node = e.node_a if node is None else node
+        _, adjacent_edges, adjacent_data = self.edge_data(node)
+        if not adjacent_edges:
+            return
+        _, edge = min(zip([d["mite_count"] for d in adjacent_data],
+                           adjacent_edges))
+        self.add_explorer(edge, e._natural_speed, explorer_id=e.id,
+                          end_behavior=e.end_behavior)
+
     def edge_speed(self, edge):
         """Computes speed for explorer on edge."""
         return self.graph[edge[0]][edge[1]]["speed"]
@@ -89,13 +532,36 @@ class Delphi(delphi_base.DelphiBase):
     def reset(self):
         self.remove_all_explorers()
         self.set_new_edge_attribute(False, "edge_played")
+        self._node_rules.reset()
+
+    def set_node_rules(self, nodes, cooldown=None, every_n=None,
+                       threshold=None, window=None):
+        """Sets firing rules of `nodes`, see `node_rules.NodeRules`."""
+        self._node_rules.set(nodes, cooldown=cooldown, every_n=every_n,
+                             threshold=threshold, window=window)
+
+    def operate_explorers(self):
+        """Operates explorers, then plays nodes whose rules fire."""
+        super().operate_explorers()
+        arrivals, self._arrivals = self._arrivals, []
+        for node in self._node_rules.fire(arrivals, self._time):
+            self.play_node(node)
 
     def explorer_at_end(self, e, node):
         """End of path behavior."""
-        self.play_node(node)
+        self.graph[e.node_a][e.node_b]["edge_played"] = True
+        # Played after all arrivals of the step are checked against rules.
+        self._arrivals.append(node)
         self.maybe_make_new_player_at_end(e)
         self.remove_explorer(e)
 
+    def explorer_meet(self, e1, e2, edge, position):
+        """Plays node nearest to meeting point if `play_meetings` is set.
+
+        Meetings count as arrivals at that node, so node rules apply."""
+        if self.play_meetings:
+            self._arrivals.append(edge[0] if position < 0.5 else edge[1])
+
     def play_node(self, node):
         """Programed node."""
         n = self.graph.nodes[node]
@@ -132,11 +598,13 @@ class Delphi(delphi_base.DelphiBase):
                     self.graph[a_e[1]][a_e[0]]["mite_count"]
                 if mc < 1:
                     possible_edges.append(a_e)
-            new_edge = random.choice(possible_edges)
-            self.add_explorer(new_edge, e._natural_speed,
-                              end_behavior=e._end_behavior)
+            if possible_edges:
+                new_edge = random.choice(possible_edges)
+                self.add_explorer(new_edge, e._natural_speed,
+                                  explorer_id=e.id, end_behavior=e._end_behavior)
 
         # # Bounce.
         if e.end_behavior == e._BOUNCE:
             self.add_explorer((e.node_b, e.node_a),
-                              natural_speed=e._natural_speed,  end_behavior=e._end_behavior)
+                              natural_speed=e._natural_speed, explorer_id=e.id,
+                              end_behavior=e._end_behavior)
@@ -8,7 +8,16 @@ from dataclasses import dataclass
 
 
 # TODO: don't hardcode.
-_PORT = mido.open_output('virtual_midi Bus 1')
+_PORT_NAME = 'virtual_midi Bus 1'
+_PORT = None
+
+
+def default_port():
+    """Opens default MIDI output on first use."""
+    global _PORT
+    if _PORT is None:
+        _PORT = mido.open_output(_PORT_NAME)
+    return _PORT
 
 
 @dataclass
@@ -20,24 +29,31 @@ class Note:
     duration: float = 0
 
 
-def start_note(note, port=_PORT):
+def start_note(note, port=None):
     """Plays note for given amount of time."""
+    if port is None:
+        port = default_port()
     start_msg = mido.Message('note_on', note=note.note)
     port.send(start_msg)
 
 
-def end_note(note, port=_PORT):
+def end_note(note, port=None):
+    if port is None:
+        port = default_port()
     end_msg = mido.Message('note_off', note=note.note)
     port.send(end_msg)
 
 
 class Squeaker(object):
 
-    _play_notes = []
-    _hold_notes = []
+    _play_notes = None
+    _hold_notes = None
+    _port = None
 
-    def __init__(self):
-        pass
+    def __init__(self, port=None):
+        self._play_notes = []
+        self._hold_notes = []
+        self._port = port
 
     def play_note(self, note):
         self._play_notes.append(note)
@@ -48,13 +64,13 @@ class Squeaker(object):
 
         # End old nodes.
         for n in e_:
-            end_note(n)
+            end_note(n, self._port)
 
         self._hold_notes = h_
         just_queued = []
         # Play new notes.
         for n in self._play_notes:
-            start_note(n)
+            start_note(n, self._port)
             n.end_time = t + n.duration
             self._hold_notes.append(n)
         self._play_notes.clear()
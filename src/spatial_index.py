@@ -0,0 +1,194 @@
+"""Spatial hashing for picking nodes and edges.
+
+Points are bucketed into a uniform grid so that nearest-point and region
+queries only visit the cells surrounding the query instead of every point."""
+
+import itertools
+
+import numpy as np
+
+
+def _ring(origin, r):
+    """Yields cells at Chebyshev distance `r` from `origin`."""
+    if r == 0:
+        yield origin
+        return
+    x0, y0, z0 = origin
+    for dx in range(-r, r + 1):
+        for dy in range(-r, r + 1):
+            if abs(dx) == r or abs(dy) == r:
+                dzs = range(-r, r + 1)
+            else:
+                dzs = (-r, r)
+            for dz in dzs:
+                yield (x0 + dx, y0 + dy, z0 + dz)
+
+
+def _ring_size(r):
+    """Number of cells at Chebyshev distance `r`."""
+    return 1 if r == 0 else (2 * r + 1) ** 3 - (2 * r - 1) ** 3
+
+
+class GridIndex(object):
+    """Uniform grid hash over keyed point sets.
+
+    Each key owns one or more points, e.g. a node position or the samples of
+    an edge curve. Keys are inserted, moved and removed individually so the
+    index can be kept up to date incrementally as geometry changes.
+
+    With `polyline=True` the points of a key are joined into a polyline: the
+    key is bucketed in every cell its segments may pass through and distances
+    are measured to the segments rather than to the points.
+    """
+
+    def __init__(self, cell_size=1.0, polyline=False):
+        if not cell_size > 0:
+            raise ValueError("`cell_size` must be positive.")
+        self._cell_size = float(cell_size)
+        self._polyline = polyline
+        self._points = {}
+        self._cells = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    @property
+    def cell_size(self):
+        return self._cell_size
+
+    def keys(self):
+        return self._points.keys()
+
+    def points(self, key):
+        return self._points[key]
+
+    def _cell(self, point):
+        return tuple(int(c) for c in np.floor(point / self._cell_size))
+
+    def _key_cells(self, points):
+        cells = np.floor(points / self._cell_size).astype(np.int64)
+        if not self._polyline or len(cells) < 2:
+            return set(map(tuple, cells.tolist()))
+
+        # Cells of the bounding box of each segment.
+        lo = np.minimum(cells[:-1], cells[1:]).tolist()
+        hi = np.maximum(cells[:-1], cells[1:]).tolist()
+        key_cells = set()
+        for a, b in zip(lo, hi):
+            key_cells.update(itertools.product(
+                *[range(a_, b_ + 1) for a_, b_ in zip(a, b)]))
+        return key_cells
+
+    def insert(self, key, points):
+        """Adds `key` located at `points` (a point or array of points)."""
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if key in self._points:
+            self.remove(key)
+        self._points[key] = points
+        for c in self._key_cells(points):
+            self._cells.setdefault(c, set()).add(key)
+
+    def remove(self, key):
+        """Removes `key` from index."""
+        points = self._points.pop(key)
+        for c in self._key_cells(points):
+            self._discard(c, key)
+
+    def _discard(self, cell, key):
+        bucket = self._cells[cell]
+        bucket.discard(key)
+        if not bucket:
+            del self._cells[cell]
+
+    def move(self, key, points):
+        """Moves `key` to `points`, only touching cells that changed."""
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        old = self._points.get(key)
+        if old is None:
+            self.insert(key, points)
+            return
+        if old.shape == points.shape and np.array_equal(old, points):
+            return
+        old_cells = self._key_cells(old)
+        new_cells = self._key_cells(points)
+        for c in old_cells - new_cells:
+            self._discard(c, key)
+        for c in new_cells - old_cells:
+            self._cells.setdefault(c, set()).add(key)
+        self._points[key] = points
+
+    def clear(self):
+        self._points = {}
+        self._cells = {}
+
+    def _distance(self, key, point):
+        points = self._points[key]
+        if not self._polyline or len(points) < 2:
+            return np.min(np.linalg.norm(points - point, axis=-1))
+
+        # Distance to closest point on each segment.
+        a, ab = points[:-1], np.diff(points, axis=0)
+        length2 = np.sum(ab * ab, axis=-1)
+        t = np.clip(np.sum((point - a) * ab, axis=-1) /
+                    np.where(length2 > 0, length2, 1), 0, 1)
+        return np.min(np.linalg.norm(a + t[:, None] * ab - point, axis=-1))
+
+    def nearest(self, point):
+        """Returns `(key, distance)` of the key nearest to `point`.
+
+        Searches rings of cells outward from the cell containing `point` and
+        stops once no unvisited cell can hold a closer point or segment.
+        Returns `(None, inf)` if the index is empty.
+        """
+        point = np.asarray(point, dtype=float)
+        best_key, best = None, np.inf
+        origin = self._cell(point)
+        seen = set()
+        r = 0
+        while self._cells:
+            if _ring_size(r) > len(self._cells):
+                # Ring is larger than the occupied grid; finish exhaustively.
+                candidates = itertools.chain.from_iterable(
+                    self._cells.values())
+            else:
+                candidates = itertools.chain.from_iterable(
+                    self._cells.get(c, ()) for c in _ring(origin, r))
+            for key in candidates:
+                if key in seen:
+                    continue
+                seen.add(key)
+                d = self._distance(key, point)
+                if d < best:
+                    best_key, best = key, d
+            if _ring_size(r) > len(self._cells):
+                break
+            # Points outside visited rings are at least `r * cell_size` away.
+            if best <= r * self._cell_size:
+                break
+            r += 1
+        return best_key, best
+
+    def within(self, corner_a, corner_b):
+        """Returns keys with at least one point inside the box spanned by
+        `corner_a` and `corner_b`."""
+        lo = np.minimum(corner_a, corner_b).astype(float)
+        hi = np.maximum(corner_a, corner_b).astype(float)
+        c_lo = self._cell(lo)
+        c_hi = self._cell(hi)
+        n_cells = np.prod([b - a + 1 for a, b in zip(c_lo, c_hi)])
+        if n_cells <= len(self._cells):
+            cells = itertools.product(
+                *[range(a, b + 1) for a, b in zip(c_lo, c_hi)])
+        else:
+            cells = [c for c in self._cells if all(
+                a <= x <= b for a, x, b in zip(c_lo, c, c_hi))]
+
+        candidates = set()
+        for c in cells:
+            candidates.update(self._cells.get(c, ()))
+
+        return [k for k in candidates if np.any(np.all(
+            (self._points[k] >= lo) & (self._points[k] <= hi), axis=-1))]
@@ -0,0 +1,74 @@
+"""Pushes explorer state to streaming clients as Server-Sent Events.
+
+The updater publishes one encoded frame per snapshot, shared by all clients.
+Each client reads the latest frame at its own rate; frames published while a
+client is busy are skipped rather than queued, so slow clients never build up
+a backlog and viewers add no work to the simulation tick."""
+
+import json
+import threading
+import time
+
+
+class StateBroadcaster(object):
+    """Holds the latest state frame and wakes waiting clients."""
+
+    def __init__(self, keep_alive=15.):
+        self._cond = threading.Condition()
+        self._frame = None
+        self._version = 0
+        self._last_publish = 0.
+        self._rates = []
+        self._keep_alive = keep_alive
+
+    @property
+    def subscribers(self):
+        return len(self._rates)
+
+    def due(self, t):
+        """Returns `True` if a client is waiting for a frame newer than `t`.
+
+        Snapshots are only needed at the fastest rate requested by any client.
+        """
+        with self._cond:
+            if not self._rates:
+                return False
+            return t - self._last_publish >= 1 / max(self._rates)
+
+    def publish(self, t, ids, points):
+        """Encodes and publishes frame of explorer `ids` and `points`."""
+        frame = json.dumps({
+            "t": t,
+            "ids": list(ids),
+            "points": [[round(c, 4) for c in p] for p in points],
+        })
+        with self._cond:
+            self._frame = frame
+            self._version += 1
+            self._last_publish = t
+            self._cond.notify_all()
+
+    def frames(self, rate):
+        """Yields SSE messages with the latest frame at most `rate` per second."""
+        with self._cond:
+            self._rates.append(rate)
+        try:
+            version = 0
+            next_time = time.time()
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._version != version,
+                                        timeout=self._keep_alive)
+                    fresh = self._version != version
+                    version, frame = self._version, self._frame
+                if not fresh:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {version}\ndata: {frame}\n\n"
+
+                # Sleep until next slot; skip slots missed by a slow client.
+                next_time = max(next_time + 1 / rate, time.time())
+                time.sleep(max(0, next_time - time.time()))
+        finally:
+            with self._cond:
+                self._rates.remove(rate)
@@ -0,0 +1,161 @@
+"""Runs parameter sweeps over headless simulations in a process pool.
+
+The graph topology and node/edge data of a base `Delphi` are extracted into
+a few small arrays and handed to each worker once, when the pool starts; every
+worker builds its own simulation from them and reuses it for all of its runs.
+Each run records summary statistics, which are written together to a single
+columnar `.npz` file (one array per column, one row per run)."""
+
+import itertools
+import multiprocessing as mp
+import random
+
+import numpy as np
+
+import rhino_delphi
+
+
+_NODE_DATA = ("note", "note_velocity", "duration")
+_PARAMETERS = ("speed_multiplier", "natural_speed", "end_behavior",
+               "seed_edges", "random_seed")
+
+# Per-process simulation built by `_init_worker`.
+_WORKER = {}
+
+
+class RecordingPlayer(object):
+    """Player recording `(time, note)` of notes instead of playing them."""
+
+    def __init__(self):
+        self.time = 0.
+        self.notes = []
+
+    def play_notes(self, notes):
+        self.notes.extend((self.time, n.note) for n in notes)
+
+
+def _topology(delphi):
+    """Extracts arrays describing graph of `delphi`."""
+    graph = delphi.graph
+    nodes = np.array(list(graph.nodes), dtype=np.int64)
+    edges = np.array([list(e) for e in delphi._init_edges],
+                     dtype=np.int64).reshape(-1, 2)
+    arrays = {"nodes": nodes, "edges": edges,
+              "speed": np.array([graph[a][b]["speed"] for a, b in edges],
+                                dtype=float)}
+    for name in _NODE_DATA:
+        arrays[name] = np.array([graph.nodes[n][name] for n in nodes.tolist()],
+                                dtype=float)
+    return arrays
+
+
+def _init_worker(arrays):
+    edges = arrays["edges"].tolist()
+
+    sn = rhino_delphi.Delphi(None, RecordingPlayer())
+    sn.set_up(arrays["nodes"].tolist(), edges)
+    sn.add_node_data(sn.graph.nodes, [arrays[n] for n in _NODE_DATA],
+                     _NODE_DATA)
+    sn.add_edge_data(edges, [arrays["speed"]], ["speed"])
+
+    _WORKER.update(arrays=arrays, delphi=sn)
+
+
+def _simulate(params, duration, dt, bin_width):
+    """Runs one simulation in worker, returns its summary statistics."""
+    sn = _WORKER["delphi"]
+    edges = _WORKER["arrays"]["edges"]
+    sn.reset()
+    sn._player = player = RecordingPlayer()
+    random.seed(params["random_seed"])
+
+    sn.add_explorers(params["seed_edges"],
+                     natural_speed=params["natural_speed"],
+                     end_behavior=params["end_behavior"])
+
+    peak = len(sn._explorers)
+    for step in range(int(round(duration / dt))):
+        player.time = step * dt
+        sn.update(dt * params["speed_multiplier"])
+        peak = max(peak, len(sn._explorers))
+
+    times = np.array([t for t, _ in player.notes], dtype=float)
+    pitches = np.array([p for _, p in player.notes], dtype=np.int64)
+    n_bins = int(np.ceil(duration / bin_width))
+    coverage = np.array([
+        sn.graph[a][b]["edge_played"] or sn.graph[b][a]["edge_played"]
+        for a, b in edges.tolist()], dtype=bool)
+
+    return {
+        "note_count": len(times),
+        "peak_explorers": peak,
+        "note_density": np.histogram(
+            times, bins=n_bins, range=(0, n_bins * bin_width))[0] / bin_width,
+        "pitch_histogram": np.bincount(
+            np.clip(pitches, 0, 127), minlength=128),
+        "edge_coverage": coverage,
+        "coverage_fraction": coverage.mean() if len(coverage) else 0.,
+    }
+
+
+def _run(args):
+    return _simulate(*args)
+
+
+def parameter_grid(grid):
+    """Expands dict of parameter lists into list of parameter dicts."""
+    unknown = set(grid) - set(_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}.")
+    names = list(grid)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[n] for n in names])]
+
+
+def run_sweep(delphi, grid, path, duration=60., dt=1 / 50, bin_width=1.,
+              processes=None):
+    """Simulates every combination in `grid` on the graph of `delphi`.
+
+    `grid` maps parameter names (`speed_multiplier`, `natural_speed`,
+    `end_behavior`, `seed_edges`, `random_seed`) to lists of values; each
+    `seed_edges` value is a list of edges to start explorers on. Parameters
+    not in `grid` default to the explorers currently on `delphi`; if
+    `seed_edges` is varied, `natural_speed` and `end_behavior` default to
+    scalars (1 and bounce) instead. Results are saved to `path` and returned
+    as dict of columns.
+    """
+    seeds = list(delphi._explorers)
+    defaults = {
+        "speed_multiplier": 1.,
+        "natural_speed": 1.,
+        "end_behavior": 0,
+        "seed_edges": [list(e.edge) for e in seeds],
+        "random_seed": 0,
+    }
+    # Per-explorer values only line up with the explorers on `delphi`.
+    if "seed_edges" not in grid and seeds:
+        defaults["natural_speed"] = [e._natural_speed for e in seeds]
+        defaults["end_behavior"] = [e.end_behavior for e in seeds]
+    runs = [{**defaults, **p} for p in parameter_grid(grid)]
+
+    with mp.Pool(processes, initializer=_init_worker,
+                 initargs=(_topology(delphi),)) as pool:
+        stats = pool.map(_run, [(p, duration, dt, bin_width) for p in runs])
+
+    # Parameter columns. `seed_edges` is stored as index into grid values.
+    columns = {}
+    for name in _PARAMETERS:
+        if name == "seed_edges":
+            options = grid.get(name, [defaults[name]])
+            columns["seed_set"] = np.array(
+                [next(i for i, o in enumerate(options) if o is p[name])
+                 for p in runs], dtype=np.int64)
+        elif name in grid:
+            columns[name] = np.array([p[name] for p in runs])
+    for key in stats[0] if stats else ():
+        columns[key] = np.array([s[key] for s in stats])
+    columns["edges"] = np.array(
+        [list(e) for e in delphi._init_edges], dtype=np.int64).reshape(-1, 2)
+
+    np.savez(path, **columns)
+    return columns
@@ -0,0 +1,158 @@
+"""Renders `send_sound.Note` streams to WAV without a MIDI synth.
+
+Voices are mixed in fixed-size blocks with NumPy: every active voice is
+evaluated for the whole block at once, so there is no per-sample Python loop.
+Blocks are written to disk as they are rendered, keeping memory flat however
+long the piece runs. The WAV header is patched and the file flushed after each
+write, so the file on disk stays playable while rendering is in progress."""
+
+import wave
+
+import numpy as np
+
+
+_TABLE_SIZE = 2048
+
+
+def midi_to_frequency(note):
+    """Converts MIDI note number to frequency in Hz."""
+    return 440. * 2 ** ((np.asarray(note, dtype=float) - 69) / 12)
+
+
+def additive_table(harmonics=(1, .5, .33, .25, .2), size=_TABLE_SIZE):
+    """Builds single-cycle wavetable from harmonic amplitudes."""
+    x = np.arange(size) / size
+    table = sum(a * np.sin(2 * np.pi * (k + 1) * x)
+                for k, a in enumerate(harmonics))
+    return table / np.max(np.abs(table))
+
+
+class Renderer(object):
+    """Streams notes to a mono 16 bit WAV file.
+
+    Notes are added with their start time in seconds (relative to the start of
+    the file) and must arrive in non-decreasing order of time. Audio is only
+    rendered up to the time passed to `render_until`, one block at a time.
+    """
+
+    def __init__(self, path, sample_rate=44100, block_size=1024,
+                 wavetable=None, attack=0.005, release=0.05, gain=0.2):
+        self._sample_rate = sample_rate
+        self._block_size = block_size
+        self._table = additive_table() if wavetable is None else np.asarray(
+            wavetable, dtype=float)
+        self._attack = max(1, int(attack * sample_rate))
+        self._release = max(1, int(release * sample_rate))
+        self._gain = gain
+        self._position = 0
+
+        # Voice arrays, one entry per sounding note.
+        self._start = np.zeros(0, dtype=np.int64)
+        self._stop = np.zeros(0, dtype=np.int64)
+        self._increment = np.zeros(0)
+        self._amplitude = np.zeros(0)
+
+        self._file = open(path, 'wb')
+        self._wav = wave.open(self._file, 'wb')
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate)
+
+    @property
+    def time(self):
+        """Time in seconds rendered so far."""
+        return self._position / self._sample_rate
+
+    @property
+    def voice_count(self):
+        return len(self._start)
+
+    def add_note(self, t, note):
+        """Starts `note` at time `t`.
+
+        Notes arriving after their start time was rendered start immediately.
+        """
+        self.add_notes([t], [note])
+
+    def add_notes(self, times, notes):
+        """Starts `notes` at `times`."""
+        if not len(notes):
+            return
+        start = np.maximum(
+            np.round(np.asarray(times) * self._sample_rate).astype(np.int64),
+            self._position)
+        duration = np.array([n.duration for n in notes], dtype=float)
+        stop = start + np.maximum(
+            1, np.round(duration * self._sample_rate)).astype(np.int64)
+        frequency = midi_to_frequency([n.note for n in notes])
+
+        self._start = np.concatenate([self._start, start])
+        self._stop = np.concatenate([self._stop, stop])
+        self._increment = np.concatenate(
+            [self._increment, frequency * len(self._table) / self._sample_rate])
+        self._amplitude = np.concatenate(
+            [self._amplitude, [n.volume / 127 for n in notes]])
+
+    def _render_block(self):
+        """Mixes all voices over the next block."""
+        n = self._position + np.arange(self._block_size)
+        elapsed = n[None, :] - self._start[:, None]
+        released = n[None, :] - self._stop[:, None]
+
+        envelope = np.minimum(
+            np.clip(elapsed / self._attack, 0, 1),
+            np.clip(1 - released / self._release, 0, 1))
+
+        index = (np.maximum(elapsed, 0) * self._increment[:, None]) % len(
+            self._table)
+        i0 = index.astype(np.int64)
+        frac = index - i0
+        wave_ = self._table[i0] * (1 - frac) + \
+            self._table[(i0 + 1) % len(self._table)] * frac
+
+        block = self._gain * np.sum(
+            self._amplitude[:, None] * envelope * wave_, axis=0)
+        self._position += self._block_size
+
+        # Retire voices whose release has finished.
+        alive = self._stop + self._release > self._position
+        self._start = self._start[alive]
+        self._stop = self._stop[alive]
+        self._increment = self._increment[alive]
+        self._amplitude = self._amplitude[alive]
+        return block
+
+    def _write(self, block):
+        pcm = (np.clip(block, -1, 1) * 32767).astype('<i2')
+        self._wav.writeframes(pcm.tobytes())
+
+    def render_until(self, t):
+        """Renders and writes whole blocks up to time `t`."""
+        end = int(t * self._sample_rate)
+        if self._position + self._block_size > end:
+            return
+        while self._position + self._block_size <= end:
+            self._write(self._render_block())
+        self._file.flush()
+
+    def close(self):
+        """Renders remaining voices until silent and closes file."""
+        if self._file.closed:
+            return
+        while len(self._start):
+            self._write(self._render_block())
+        self._wav.close()
+        self._file.close()
+
+
+def render(events, path, **kwargs):
+    """Renders `(time, note)` pairs, sorted by time, to WAV file at `path`.
+
+    `events` may be any iterable (e.g. a generator), it is consumed lazily.
+    Keyword arguments are passed to `Renderer`."""
+    r = Renderer(path, **kwargs)
+    for t, note in events:
+        r.render_until(t)
+        r.add_note(t, note)
+    r.close()
+    return r.time
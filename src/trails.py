@@ -0,0 +1,94 @@
+"""Keeps recent positions of explorers for drawing motion trails.
+
+Positions are written to preallocated NumPy ring buffers, one row per explorer
+and one column per tick, so memory depends on trail length and population but
+not on how long a session runs."""
+
+import numpy as np
+
+
+class TrailBuffer(object):
+    """Ring buffer of the last `length` `(edge, location)` of each explorer.
+
+    Explorers are identified by id. Rows are acquired when an explorer is
+    added and released when it is removed, so recording a tick is a single
+    scatter into the buffer; the buffer only grows (doubling) when more
+    explorers are alive at once than it has rows.
+    """
+
+    def __init__(self, length=32, capacity=1024):
+        if length < 1:
+            raise ValueError("`length` must be at least 1.")
+        self._length = length
+        self._edges = np.full((capacity, length), -1, dtype=np.int32)
+        self._locs = np.zeros((capacity, length), dtype=np.float32)
+        # Tick at which each row was assigned.
+        self._born = np.zeros(capacity, dtype=np.int64)
+        self._slots = {}
+        self._free = list(range(capacity - 1, -1, -1))
+        self._tick = -1
+
+    @property
+    def length(self):
+        return self._length
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _grow(self):
+        capacity = len(self._edges)
+        self._edges = np.concatenate(
+            [self._edges, np.full_like(self._edges, -1)])
+        self._locs = np.concatenate([self._locs, np.zeros_like(self._locs)])
+        self._born = np.concatenate([self._born, np.zeros_like(self._born)])
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def acquire(self, explorer_id):
+        """Returns row of `explorer_id`, assigning a free row on first use."""
+        slot = self._slots.get(explorer_id)
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._slots[explorer_id] = self._free.pop()
+            # Trail starts with the next recorded tick.
+            self._born[slot] = self._tick + 1
+        return slot
+
+    def release(self, explorer_id):
+        """Frees row of `explorer_id`."""
+        slot = self._slots.pop(explorer_id, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def clear(self):
+        """Frees all rows."""
+        self._free.extend(self._slots.values())
+        self._slots = {}
+
+    def slots(self, ids):
+        """Returns rows of `ids` as list."""
+        return list(map(self._slots.__getitem__, ids))
+
+    def record(self, slots, edges, locs):
+        """Writes one tick of positions to rows `slots`."""
+        self._tick += 1
+        column = self._tick % self._length
+        self._edges[slots, column] = edges
+        self._locs[slots, column] = locs
+
+    def query(self, ids=None):
+        """Returns `(ids, edges, locs, counts)` of trails, oldest first.
+
+        `edges` and `locs` are arrays of shape `(len(ids), length)`; only the
+        last `counts[i]` entries of row `i` hold recorded positions. Unknown
+        ids are skipped."""
+        if ids is None:
+            ids = list(self._slots)
+        ids = [i for i in ids if i in self._slots]
+        slots = np.array([self._slots[i] for i in ids], dtype=np.int64)
+
+        order = (self._tick - np.arange(self._length)[::-1]) % self._length
+        edges = self._edges[slots][:, order]
+        locs = self._locs[slots][:, order]
+        counts = np.minimum(self._tick - self._born[slots] + 1, self._length)
+        return ids, edges, locs, counts